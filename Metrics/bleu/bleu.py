@@ -15,7 +15,7 @@ class Bleu(object):
         self._hypo_for_image = {}
         self.ref_for_image = {}
 
-    def compute_score(self, gts, res):
+    def _cook(self, gts, res):
         bleu_scorer = BleuScorer(n=self._n)
 
         for idx in sorted(gts.keys()):
@@ -30,6 +30,27 @@ class Bleu(object):
 
             bleu_scorer += (hypo[0], ref)
 
+        return bleu_scorer
+
+    def compute_score(self, gts, res):
+        bleu_scorer = self._cook(gts, res)
+        score, scores = bleu_scorer.compute_score(option='closest', verbose=0)
+
+        return score, scores
+
+    def compute_stats(self, gts, res):
+        """
+        Per-segment sufficient statistics (test length, reference lengths,
+        n-gram guess and correct counts), mergeable with merge_stats
+        """
+        return list(self._cook(gts, res).ctest)
+
+    def merge_stats(self, stats):
+        """
+        Score the concatenation of statistics from compute_stats
+        """
+        bleu_scorer = BleuScorer(n=self._n)
+        bleu_scorer.ctest.extend(stats)
         score, scores = bleu_scorer.compute_score(option='closest', verbose=0)
 
         return score, scores
@@ -12,6 +12,7 @@ into a form usable by score_cooked().
 
 import copy
 import math
+import bisect
 from collections import defaultdict
 
 
@@ -28,10 +29,28 @@ def precook(s, n=4, out=False):
     return len(words), counts
 
 
+def closest_reflen(reflens, testlen):
+    """Returns the reference length closest to testlen, the shorter one
+    on ties, i.e. min((abs(l - testlen), l) for l in reflens).
+    reflens must be sorted in ascending order."""
+    i = bisect.bisect_left(reflens, testlen)
+
+    if i == 0:
+        return reflens[0]
+
+    if i == len(reflens):
+        return reflens[-1]
+
+    shorter, longer = reflens[i - 1], reflens[i]
+
+    return shorter if testlen - shorter <= longer - testlen else longer
+
+
 def cook_refs(refs, eff=None, n=4):  # lhuang: oracle will call with "average"
     """Takes a list of reference sentences for a single segment
     and returns an object that encapsulates everything that BLEU
-    needs to know about them.
+    needs to know about them. The list of reference lengths is sorted,
+    so that the closest one can be found by bisection.
     """
 
     reflen = []
@@ -43,6 +62,8 @@ def cook_refs(refs, eff=None, n=4):  # lhuang: oracle will call with "average"
         for (ngram,count) in counts.items():
             maxcounts[ngram] = max(maxcounts.get(ngram, 0), count)
 
+    reflen.sort()
+
     # Calculate effective reference sentence length.
     if eff == "shortest":
         reflen = min(reflen)
@@ -65,7 +86,7 @@ def cook_test(test, ref_len_counts, eff=None, n=4):
 
     # Calculate effective reference sentence length.
     if eff == "closest":
-        result["reflen"] = min((abs(l - testlen), l) for l in reflen)[1]
+        result["reflen"] = closest_reflen(reflen, testlen)
     else:
         result["reflen"] = reflen
 
@@ -84,12 +105,17 @@ class BleuScorer(object):
     """BLEU scorer."""
 
     __slots__ = "n", "crefs", "ctest", "_score", \
-        "_ratio", "_testlen", "_reflen", "special_reflen"
+        "_ratio", "_testlen", "_reflen", "special_reflen", \
+        "_cooked_refs", "_cooked_tests"
 
     def __init__(self, test=None, refs=None, n=4, special_reflen=None):
         self.n = n
         self.crefs = []
         self.ctest = []
+        # repeated reference sets and (test, refs) pairs are cooked once
+        # and shared, keyed by their whitespace-normalized sentences
+        self._cooked_refs = {}
+        self._cooked_tests = {}
         self.cook_append(test, refs)
         self.special_reflen = special_reflen
 
@@ -108,9 +134,22 @@ class BleuScorer(object):
         to avoid creating new instances."""
 
         if refs is not None:
-            self.crefs.append(cook_refs(refs))
+            refs_key = tuple(sorted(" ".join(ref.split()) for ref in refs))
+            cooked_refs = self._cooked_refs.get(refs_key)
+
+            if cooked_refs is None:
+                cooked_refs = self._cooked_refs[refs_key] = cook_refs(refs)
+
+            self.crefs.append(cooked_refs)
+
             if test is not None:
-                cooked_test = cook_test(test, self.crefs[-1])
+                test_key = (" ".join(test.split()), refs_key)
+                cooked_test = self._cooked_tests.get(test_key)
+
+                if cooked_test is None:
+                    cooked_test = self._cooked_tests[test_key] = \
+                        cook_test(test, cooked_refs)
+
                 self.ctest.append(cooked_test)
             else:
                 self.ctest.append(None)
@@ -190,7 +229,7 @@ class BleuScorer(object):
         elif option == "average":
             reflen = float(sum(reflens)) / len(reflens)
         elif option == "closest":
-            reflen = min((abs(l - testlen), l) for l in reflens)[1]
+            reflen = closest_reflen(reflens, testlen)
         else:
             raise ValueError("Unknown reflen option %s" % option)
 
@@ -4,7 +4,9 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-from Metrics.cider.cider_scorer import CiderScorer
+import numpy as np
+
+from Metrics.cider.cider_scorer import CiderScorer, DocFreq, load_doc_freq
 
 
 class Cider(object):
@@ -12,11 +14,41 @@ class Cider(object):
     Main Class to compute the CIDEr metric
     """
 
-    def __init__(self, test=None, refs=None, n=4, sigma=6.0):
+    def __init__(self, test=None, refs=None, n=4, sigma=6.0,
+                 clip=True, df=None, df_ref_len=None):
         # set cider to sum over 1 to 4-grams
         self._n = n
         # set the standard deviation parameter for gaussian penalty
         self._sigma = sigma
+        # clip hypothesis tf-idf by the reference, CIDEr-D when set
+        self._clip = clip
+        # document frequency table (or the path of a pickled one),
+        # None computes it from the references of each call
+        if isinstance(df, str):
+            df = load_doc_freq(df, df_ref_len)
+
+        self._df = df
+
+    def _scorer(self):
+        return CiderScorer(n=self._n, sigma=self._sigma,
+                           clip=self._clip, df=self._df)
+
+    def _cook(self, gts, res):
+        cider_scorer = self._scorer()
+
+        for idx in sorted(gts.keys()):
+            hypo = res[idx]
+            ref = gts[idx]
+
+            # Sanity check.
+            assert(isinstance(hypo, list))
+            assert(isinstance(ref, list))
+            assert(len(hypo) == 1)
+            assert(len(ref) > 0)
+
+            cider_scorer += (hypo[0], ref)
+
+        return cider_scorer
 
     def compute_score(self, gts, res):
         """
@@ -26,7 +58,17 @@ class Cider(object):
         :return: cider (float): computed CIDEr score for the corpus
         """
 
-        cider_scorer = CiderScorer(n=self._n, sigma=self._sigma)
+        return self._cook(gts, res).compute_score()
+
+    def compute_stats(self, gts, res):
+        """
+        Per-segment whitespace-normalized hypothesis and references,
+        mergeable with merge_stats. The sentences are much smaller than
+        their cooked n-gram counts, which merge_stats computes again.
+        :return: list of (string, list of string)
+        """
+
+        stats = []
 
         for idx in sorted(gts.keys()):
             hypo = res[idx]
@@ -38,10 +80,103 @@ class Cider(object):
             assert(len(hypo) == 1)
             assert(len(ref) > 0)
 
-            cider_scorer += (hypo[0], ref)
+            stats.append((" ".join(hypo[0].split()),
+                          [" ".join(sentence.split()) for sentence in ref]))
+
+        return stats
+
+    def merge_stats(self, stats):
+        """
+        Score the concatenation of statistics from compute_stats, document
+        frequencies are computed over all merged references
+        :return: cider (float): computed CIDEr score for the corpus
+        """
+
+        cider_scorer = self._scorer()
+
+        for hypo, ref in stats:
+            cider_scorer += (hypo, ref)
 
         return cider_scorer.compute_score()
 
+    def stream_doc_freq(self, refs, spill=None):
+        """
+        First pass of streaming CIDEr: build the document frequency table
+        :param refs: iterable of list of string : references of each segment
+        :param spill: str : new sqlite database to spill the table to,
+                            optional, removed by close_doc_freq
+        :return: table (dict) for compute_score_streaming
+        """
+
+        if self._df is not None:
+            return self._df
+
+        doc_freq = DocFreq(n=self._n, path=spill)
+
+        try:
+            for ref in refs:
+                doc_freq.add(ref)
+        except BaseException:
+            doc_freq.close()
+            raise
+
+        return doc_freq.table()
+
+    @staticmethod
+    def close_doc_freq(df):
+        """
+        Release a table from stream_doc_freq, removing its spill database
+        :param df: dict : table from stream_doc_freq
+        :return: None
+        """
+
+        if isinstance(df["document_frequency"], DocFreq):
+            df["document_frequency"].close()
+
+    def compute_score_streaming(self, segments, df, chunk_size=1000):
+        """
+        Second pass of streaming CIDEr: score (hypothesis, references)
+        segments without keeping their cooked n-grams, `chunk_size`
+        segments are cooked at a time
+        :param segments: iterable of (string, list of string)
+        :param df: dict : table from stream_doc_freq
+        :return: cider (float): computed CIDEr score for the corpus
+        """
+
+        scores = []
+        cider_scorer = None
+
+        for hypo, ref in segments:
+            # Sanity check.
+            assert(len(ref) > 0)
+
+            if cider_scorer is None:
+                cider_scorer = CiderScorer(n=self._n, sigma=self._sigma,
+                                           clip=self._clip, df=df)
+
+            cider_scorer += (hypo, ref)
+
+            if cider_scorer.size() >= chunk_size:
+                scores.extend(self._compute_chunk(cider_scorer, df))
+                cider_scorer = None
+
+        if cider_scorer is not None:
+            scores.extend(self._compute_chunk(cider_scorer, df))
+
+        return np.mean(np.array(scores)), np.array(scores)
+
+    @staticmethod
+    def _compute_chunk(cider_scorer, df):
+        document_frequency = df["document_frequency"]
+
+        if isinstance(document_frequency, DocFreq):
+            # a spilled table is read once per chunk, not once per n-gram
+            document_frequency.prefetch(
+                ngram for counts in cider_scorer.cooked.values()
+                for ngram in counts)
+
+        return cider_scorer.compute_cider()
+
     @staticmethod
     def method():
         return "CIDEr"
@@ -4,8 +4,12 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import os
 import copy
 import math
+import hashlib
+import pickle
+import sqlite3
 import numpy as np
 
 from collections import defaultdict
@@ -53,24 +57,278 @@ def cook_test(test, n=4):
     return precook(test, n, True)
 
 
+def build_doc_freq(refs, n=4):
+    """
+    Compute a document frequency table from the references of a corpus.
+    :param refs: iterable of list of string : reference sentences of each segment
+    :param n: int : number of ngrams
+    :return: table (dict) with the document frequency of every ngram and
+             the log number of segments (ref_len)
+    """
+
+    document_frequency = defaultdict(float)
+    num_refs = 0
+
+    for ref in refs:
+        num_refs += 1
+
+        for ngram in set(ngram for counts in cook_refs(ref, n)
+                         for ngram in counts):
+            document_frequency[ngram] += 1
+
+    return {"document_frequency": dict(document_frequency),
+            "ref_len": np.log(float(num_refs))}
+
+
+def save_doc_freq(table, path):
+    """
+    Save a document frequency table from build_doc_freq. As in the
+    self-critical CIDEr-D df files, ref_len is stored as the number of
+    segments, not its log.
+    :param table: dict : document frequency table
+    :param path: str : output file
+    :return: None
+    """
+
+    with open(path, "wb") as fd:
+        pickle.dump({"document_frequency": table["document_frequency"],
+                     "ref_len": int(round(np.exp(table["ref_len"])))},
+                    fd, pickle.HIGHEST_PROTOCOL)
+
+
+def doc_freq_digest(document_frequency):
+    """
+    Hash of the content of a document frequency table, to tell apart
+    tables of the same size
+    :param document_frequency: dict : ngram (tuple) -> document frequency
+    :return: hex digest (str)
+    """
+
+    digest = hashlib.sha1()
+
+    for ngram, df in sorted(document_frequency.items()):
+        digest.update(("%s\t%r\n" % (" ".join(ngram), float(df)))
+                      .encode("utf-8"))
+
+    return digest.hexdigest()
+
+
+def load_doc_freq(path, ref_len=None):
+    """
+    Load a document frequency table, either saved by save_doc_freq (or the
+    self-critical CIDEr-D, a dict of document_frequency and the number of
+    segments ref_len), or a bare {ngram: df} dict as the coco-caption
+    CIDEr-D "coco-val-df.p", which needs `ref_len` (40504 for coco-val-df.p)
+    :param path: str : input file
+    :param ref_len: int : number of segments the table was computed from,
+                          overrides the one stored in the file
+    :return: table (dict) with the log number of segments as ref_len and
+             the digest of the document frequencies
+    """
+
+    with open(path, "rb") as fd:
+        # latin1 reads the str keys of python 2 pickles
+        table = pickle.load(fd, encoding="latin1")
+
+    if not isinstance(table, dict):
+        raise ValueError("%s is not a document frequency table" % path)
+
+    if "document_frequency" in table:
+        document_frequency = table["document_frequency"]
+
+        if ref_len is None:
+            ref_len = table.get("ref_len")
+    else:
+        document_frequency = table
+
+    if ref_len is None:
+        raise ValueError("%s does not store ref_len, the number of segments "
+                         "of its corpus must be given" % path)
+
+    return {"document_frequency": document_frequency,
+            "ref_len": np.log(float(ref_len)),
+            "digest": doc_freq_digest(document_frequency)}
+
+
+class DocFreq(object):
+    """
+    Document frequency table built one segment at a time, for streaming
+    evaluation. n-grams are keyed by their space-joined tokens, which is
+    more compact than tuples. With `path`, counts are buffered in memory
+    and spilled to an sqlite database so that the table does not need to
+    fit in RAM. The database is a new file owned by the table, removed by
+    close.
+    """
+
+    def __init__(self, n=4, path=None, buffer_size=1000000):
+        """
+        :param n: int : number of ngrams
+        :param path: str : new (or empty) sqlite database to spill the table
+                           to, None keeps it in memory
+        :param buffer_size: int : number of n-grams buffered before a spill
+        """
+        self.n = n
+        self.num_refs = 0
+        self.buffer_size = buffer_size
+        self.counts = defaultdict(int)
+        self.path = path
+        self.db = None
+        # counts read from the database by prefetch
+        self.prefetched = {}
+
+        if path is not None:
+            if os.path.exists(path) and os.path.getsize(path) > 0:
+                raise ValueError("%s already exists, the document frequency "
+                                 "table must be spilled to a new file" % path)
+
+            self.db = sqlite3.connect(path)
+            # the database is scratch space rebuilt on every run, it does
+            # not need to survive a crash
+            self.db.execute("PRAGMA journal_mode = OFF")
+            self.db.execute("PRAGMA synchronous = OFF")
+            # without rowid, an n-gram is found in one b-tree instead of
+            # the primary key index and then the table
+            self.db.execute("CREATE TABLE df (ngram TEXT PRIMARY KEY, "
+                            "count INTEGER) WITHOUT ROWID")
+
+    def add(self, refs):
+        """
+        Count the n-grams of the references of one segment
+        :param refs: list of string : reference sentences
+        :return: None
+        """
+
+        self.num_refs += 1
+
+        for ngram in set(ngram for counts in cook_refs(refs, self.n)
+                         for ngram in counts):
+            self.counts[" ".join(ngram)] += 1
+
+        if self.db is not None and len(self.counts) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Spill the buffered counts to the database
+        :return: None
+        """
+
+        if self.db is None or not self.counts:
+            return
+
+        self.db.executemany("INSERT OR IGNORE INTO df VALUES (?, 0)",
+                            ((ngram,) for ngram in self.counts))
+        self.db.executemany("UPDATE df SET count = count + ? WHERE ngram = ?",
+                            ((count, ngram)
+                             for ngram, count in self.counts.items()))
+        self.db.commit()
+        self.counts = defaultdict(int)
+
+    def prefetch(self, ngrams, batch_size=900):
+        """
+        Read the counts of `ngrams` from the database in a few queries, so
+        that the following calls to get do not query one n-gram at a time.
+        Replaces the counts of the previous prefetch.
+        :param ngrams: iterable of tuple : n-grams, e.g. of a chunk of segments
+        :param batch_size: int : n-grams per query, below the sqlite limit on
+                                 the number of query parameters
+        :return: None
+        """
+
+        if self.db is None:
+            return
+
+        # sorted keys are looked up in b-tree order
+        keys = sorted(set(" ".join(ngram) for ngram in ngrams))
+        # n-grams missing from the table are cached as None
+        self.prefetched = dict.fromkeys(keys)
+
+        for i in range(0, len(keys), batch_size):
+            batch = keys[i:i + batch_size]
+            self.prefetched.update(self.db.execute(
+                "SELECT ngram, count FROM df WHERE ngram IN (%s)"
+                % ", ".join("?" * len(batch)), batch))
+
+    def get(self, ngram, default=0.0):
+        key = " ".join(ngram)
+
+        if self.db is None:
+            return self.counts.get(key, default)
+
+        if key in self.prefetched:
+            count = self.prefetched[key]
+        else:
+            row = self.db.execute("SELECT count FROM df WHERE ngram = ?",
+                                  (key,)).fetchone()
+            count = None if row is None else row[0]
+
+        return default if count is None else count
+
+    def close(self):
+        """
+        Close the database and remove its file, the table cannot be used
+        afterwards
+        :return: None
+        """
+
+        if self.db is None:
+            return
+
+        self.db.close()
+        self.db = None
+        self.prefetched = {}
+        os.remove(self.path)
+
+    def table(self):
+        """
+        The table in the format taken by CiderScorer(df=...)
+        :return: table (dict)
+        """
+
+        self.flush()
+
+        return {"document_frequency": self,
+                "ref_len": np.log(float(self.num_refs))}
+
+
 class CiderScorer(object):
     """CIDEr scorer"""
 
-    def __init__(self, test=None, refs=None, n=4, sigma=6.0):
-        """singular instance"""
+    def __init__(self, test=None, refs=None, n=4, sigma=6.0,
+                 clip=True, df=None):
+        """
+        singular instance
+        :param sigma: float : standard deviation of the CIDEr-D length
+                              penalty, None disables the penalty
+        :param clip: bool : clip hypothesis tf-idf by the reference (CIDEr-D)
+        :param df: dict : precomputed document frequency table from
+                          build_doc_freq/load_doc_freq, None derives the
+                          document frequency from the scored references
+        """
         self.n = n
         self.sigma = sigma
+        self.clip = clip
         self.crefs = []
         self.ctest = []
+        # repeated sentences share one cooked dict,
+        # keyed by their whitespace-normalized form
+        self.cooked = {}
         self.document_frequency = defaultdict(float)
         self.cook_append(test, refs)
         self.ref_len = None
+        self.df = df
+
+        if df is not None:
+            self.document_frequency = df["document_frequency"]
+            self.ref_len = df["ref_len"]
 
     def copy(self):
         """copy the refs"""
-        new = CiderScorer(n=self.n)
+        new = CiderScorer(n=self.n, sigma=self.sigma,
+                          clip=self.clip, df=self.df)
         new.ctest = copy.copy(self.ctest)
         new.crefs = copy.copy(self.crefs)
+        new.cooked = self.cooked
         return new
 
     def cook_append(self, test, refs):
@@ -79,12 +337,21 @@ class CiderScorer(object):
         """
 
         if refs is not None:
-            self.crefs.append(cook_refs(refs))
+            self.crefs.append([self._cook(ref) for ref in refs])
             if test is not None:
-                self.ctest.append(cook_test(test))
+                self.ctest.append(self._cook(test))
             else:
                 self.ctest.append(None)
 
+    def _cook(self, sentence):
+        key = " ".join(sentence.split())
+        counts = self.cooked.get(key)
+
+        if counts is None:
+            counts = self.cooked[key] = precook(key, self.n)
+
+        return counts
+
     def size(self):
         len_refs = len(self.crefs)
         len_test = len(self.ctest)
@@ -136,7 +403,7 @@ class CiderScorer(object):
 
             for (ngram,term_freq) in cnts.items():
                 # give word count 1 if it doesn't appear in reference corpus
-                df = np.log(max(1.0, self.document_frequency[ngram]))
+                df = np.log(max(1.0, self.document_frequency.get(ngram, 0.0)))
                 # ngram index
                 n = len(ngram) - 1
                 # tf (term_freq) * idf (precomputed idf) for n-grams
@@ -170,31 +437,57 @@ class CiderScorer(object):
             for n in range(self.n):
                 # ngram
                 for (ngram,count) in vec_hyp[n].items():
-                    # vrama91 : added clipping
-                    val[n] += min(vec_hyp[n][ngram], vec_ref[n][ngram]) * vec_ref[n][ngram]
+                    if self.clip:
+                        # vrama91 : added clipping
+                        val[n] += min(vec_hyp[n][ngram], vec_ref[n][ngram]) * vec_ref[n][ngram]
+                    else:
+                        val[n] += vec_hyp[n][ngram] * vec_ref[n][ngram]
 
                 if (norm_hyp[n] != 0) and (norm_ref[n] != 0):
                     val[n] /= (norm_hyp[n] * norm_ref[n])
 
                 assert(not math.isnan(val[n]))
-                # vrama91: added a length based gaussian penalty
-                val[n] *= np.e ** (-(delta ** 2) / (2 * self.sigma ** 2))
+                if self.sigma:
+                    # vrama91: added a length based gaussian penalty
+                    val[n] *= np.e ** (-(delta ** 2) / (2 * self.sigma ** 2))
 
             return val
 
-        # compute log reference length
-        self.ref_len = np.log(float(len(self.crefs)))
+        # tf-idf vectors and pairwise similarities of shared cooked dicts
+        # are computed once, the dicts stay alive in ctest/crefs so their
+        # ids are stable keys
+        vecs = {}
+        sims = {}
+
+        def cached_vec(cnts):
+            key = id(cnts)
+
+            if key not in vecs:
+                vecs[key] = counts2vec(cnts)
+
+            return vecs[key]
+
+        if self.df is None:
+            # compute log reference length
+            self.ref_len = np.log(float(len(self.crefs)))
+
         scores = []
 
         for test, refs in zip(self.ctest, self.crefs):
             # compute vector for test captions
-            vec, norm, length = counts2vec(test)
+            vec, norm, length = cached_vec(test)
             # compute vector for ref captions
             score = np.array([0.0 for _ in range(self.n)])
 
             for ref in refs:
-                vec_ref, norm_ref, length_ref = counts2vec(ref)
-                score += sim(vec, vec_ref, norm, norm_ref, length, length_ref)
+                key = (id(test), id(ref))
+
+                if key not in sims:
+                    vec_ref, norm_ref, length_ref = cached_vec(ref)
+                    sims[key] = sim(vec, vec_ref, norm,
+                                    norm_ref, length, length_ref)
+
+                score += sims[key]
 
             # change by vrama91 - mean of ngram scores, instead of sum
             score_avg = np.mean(score)
@@ -208,10 +501,11 @@ class CiderScorer(object):
         return scores
 
     def compute_score(self, option=None, verbose=0):
-        # compute idf
-        self.compute_doc_freq()
-        # assert to check document frequency
-        assert(len(self.ctest) >= max(self.document_frequency.values()))
+        if self.df is None:
+            # compute idf
+            self.compute_doc_freq()
+            # assert to check document frequency
+            assert(len(self.ctest) >= max(self.document_frequency.values()))
         # compute cider score
         score = self.compute_cider()
         return np.mean(np.array(score)), np.array(score)
@@ -12,14 +12,27 @@ import pkg_resources
 METEOR_JAR = "./meteor-1.5.jar"
 
 
+def meteor_cmd(language="en", norm=True):
+    cmd = ["java", "-jar", "-Xmx2G", METEOR_JAR,
+           "-", "-", "-stdio", "-l", language]
+
+    if norm:
+        cmd.append("-norm")
+
+    return cmd
+
+
+def score_line(refs, hypo):
+    # SCORE ||| reference 1 words ||| reference n words ||| hypothesis words
+    hypothesis_str = hypo.replace("|||", "").replace("  ", " ")
+
+    return " ||| ".join(("SCORE", " ||| ".join(refs), hypothesis_str))
+
+
 class Meteor(object):
 
     def __init__(self, language="en", norm=True):
-        self.meteor_cmd = ["java", "-jar", "-Xmx2G", METEOR_JAR,
-                           "-", "-", "-stdio", "-l", language]
-
-        if norm:
-            self.meteor_cmd.append("-norm")
+        self.meteor_cmd = meteor_cmd(language, norm)
 
         self.meteor_p = subprocess.Popen(
             self.meteor_cmd, stdin=subprocess.PIPE,
@@ -30,29 +43,47 @@ class Meteor(object):
         # Used to guarantee thread safety
         self.lock = threading.Lock()
 
-    def compute_score(self, gts, res):
+    def compute_stats(self, gts, res):
+        """
+        Per-segment METEOR statistics lines, mergeable with merge_stats
+        """
+
         imgIds = sorted(list(gts.keys()))
-        scores = []
-        eval_line = "EVAL"
+        # repeated (hypothesis, references) segments reuse their stats
+        # instead of another round trip to the METEOR process
+        stats = {}
+        stat_lines = []
         self.lock.acquire()
 
         for i in imgIds:
             assert(len(res[i]) == 1)
 
-            hypothesis_str = res[i][0].replace("|||", "").replace("  ", " ")
-            score_line = " ||| ".join(
-                ("SCORE", " ||| ".join(gts[i]), hypothesis_str))
+            line = score_line(gts[i], res[i][0])
 
-            # SCORE ||| reference 1 words ||| reference n words ||| hypothesis words
-            self.meteor_p.stdin.write(score_line + "\n")
-            stat = self.meteor_p.stdout.readline().strip()
-            eval_line += " ||| {}".format(stat)
+            if line not in stats:
+                self.meteor_p.stdin.write(line + "\n")
+                stats[line] = self.meteor_p.stdout.readline().strip()
+
+            stat_lines.append(stats[line])
+
+        self.lock.release()
+
+        return stat_lines
+
+    def merge_stats(self, stats):
+        """
+        Score the concatenation of statistics lines from compute_stats
+        """
+
+        scores = []
+        eval_line = " ||| ".join(["EVAL"] + list(stats))
+        self.lock.acquire()
 
         # Send to METEOR
         self.meteor_p.stdin.write(eval_line + "\n")
 
         # Collect segment scores
-        for i in range(len(imgIds)):
+        for _ in range(len(stats)):
             score = float(self.meteor_p.stdout.readline().strip())
             scores.append(score)
 
@@ -62,6 +93,9 @@ class Meteor(object):
 
         return final_score, scores
 
+    def compute_score(self, gts, res):
+        return self.merge_stats(self.compute_stats(gts, res))
+
     def __del__(self):
         self.lock.acquire()
         self.meteor_p.stdin.close()
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import asyncio
+
+from Metrics.meteor.meteor import meteor_cmd, score_line
+
+
+class AsyncMeteor(object):
+    """
+    METEOR client for asyncio, talking to the METEOR jar through an
+    asyncio subprocess instead of blocking pipe reads.
+    """
+
+    def __init__(self, language="en", norm=True):
+        self.meteor_cmd = meteor_cmd(language, norm)
+        self.meteor_p = None
+        self.lock = None
+        # running exchanges, referenced until they finish
+        self.exchanges = set()
+
+    async def start(self):
+        # the lock is created here so that it belongs to the running loop
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+
+        async with self.lock:
+            if self.meteor_p is None:
+                self.meteor_p = await asyncio.create_subprocess_exec(
+                    *self.meteor_cmd, stdin=asyncio.subprocess.PIPE,
+                    cwd=os.path.dirname(os.path.abspath(__file__)),
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.DEVNULL)
+
+    async def _write(self, line):
+        self.meteor_p.stdin.write((line + "\n").encode("utf-8"))
+        await self.meteor_p.stdin.drain()
+
+    async def _readline(self):
+        line = await self.meteor_p.stdout.readline()
+
+        return line.decode("utf-8").strip()
+
+    async def _locked(self, exchange, *args):
+        # the METEOR protocol is sequential, concurrent requests take turns
+        async with self.lock:
+            return await exchange(*args)
+
+    async def _run(self, exchange, *args):
+        """
+        Run one exchange with the METEOR process. The exchange is a task of
+        its own that always reads all the replies to its requests, so that
+        cancelling the caller midway does not leave replies in the pipe for
+        the next exchange to read.
+        """
+
+        await self.start()
+        task = asyncio.ensure_future(self._locked(exchange, *args))
+        self.exchanges.add(task)
+        task.add_done_callback(self.exchanges.discard)
+
+        return await asyncio.shield(task)
+
+    async def _compute_stats(self, gts, res):
+        stats = {}
+        stat_lines = []
+
+        for i in sorted(gts.keys()):
+            assert(len(res[i]) == 1)
+
+            line = score_line(gts[i], res[i][0])
+
+            if line not in stats:
+                await self._write(line)
+                stats[line] = await self._readline()
+
+            stat_lines.append(stats[line])
+
+        return stat_lines
+
+    async def _merge_stats(self, stats):
+        scores = []
+
+        # Send to METEOR
+        await self._write(" ||| ".join(["EVAL"] + list(stats)))
+
+        # Collect segment scores
+        for _ in range(len(stats)):
+            scores.append(float(await self._readline()))
+
+        # Final score
+        final_score = 100 * float(await self._readline())
+
+        return final_score, scores
+
+    async def compute_stats(self, gts, res):
+        """
+        Per-segment METEOR statistics lines, mergeable with merge_stats
+        """
+
+        return await self._run(self._compute_stats, gts, res)
+
+    async def merge_stats(self, stats):
+        """
+        Score the concatenation of statistics lines from compute_stats
+        """
+
+        return await self._run(self._merge_stats, stats)
+
+    async def compute_score(self, gts, res):
+        return await self.merge_stats(await self.compute_stats(gts, res))
+
+    async def close(self):
+        if self.lock is None:
+            return
+
+        async with self.lock:
+            if self.meteor_p is not None:
+                self.meteor_p.stdin.close()
+                await self.meteor_p.wait()
+                self.meteor_p = None
+
+    @staticmethod
+    def method():
+        return "METEOR"
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import re
+import string
+import unicodedata
+
+# split every ASCII punctuation character from its neighbours
+_PUNCT_TABLE = dict((ord(c), u" %s " % c) for c in string.punctuation)
+
+# Penn Treebank tokenization rules, after NLTK's TreebankWordTokenizer
+_PTB_STARTING_QUOTES = [
+    (re.compile(r'^\"'), r"``"),
+    (re.compile(r"(``)"), r" \1 "),
+    (re.compile(r"([ \(\[{<])(\"|\'{2})"), r"\1 `` "),
+]
+
+_PTB_PUNCTUATION = [
+    (re.compile(r"([:,])([^\d])"), r" \1 \2"),
+    (re.compile(r"([:,])$"), r" \1 "),
+    (re.compile(r"\.\.\."), r" ... "),
+    (re.compile(r"[;@#$%&]"), r" \g<0> "),
+    (re.compile(r"([^\.])(\.)([\]\)}>\"\']*)\s*$"), r"\1 \2\3 "),
+    (re.compile(r"[?!]"), r" \g<0> "),
+    (re.compile(r"([^'])' "), r"\1 ' "),
+]
+
+_PTB_PARENS = [
+    (re.compile(r"[\]\[\(\)\{\}\<\>]"), r" \g<0> "),
+    (re.compile(r"--"), r" -- "),
+]
+
+_PTB_ENDING_QUOTES = [
+    (re.compile(r'"'), " '' "),
+    (re.compile(r"(\S)(\'\')"), r"\1 \2 "),
+    (re.compile(r"([^' ])('[sS]|'[mM]|'[dD]|') "), r"\1 \2 "),
+    (re.compile(r"([^' ])('ll|'LL|'re|'RE|'ve|'VE|n't|N'T) "), r"\1 \2 "),
+]
+
+_PTB_CONTRACTIONS = [
+    re.compile(r"(?i)\b(can)(?#X)(not)\b"),
+    re.compile(r"(?i)\b(d)(?#X)('ye)\b"),
+    re.compile(r"(?i)\b(gim)(?#X)(me)\b"),
+    re.compile(r"(?i)\b(gon)(?#X)(na)\b"),
+    re.compile(r"(?i)\b(got)(?#X)(ta)\b"),
+    re.compile(r"(?i)\b(lem)(?#X)(me)\b"),
+    re.compile(r"(?i)\b(more)(?#X)('n)\b"),
+    re.compile(r"(?i)\b(wan)(?#X)(na)(?=\s)"),
+    re.compile(r"(?i) ('t)(?#X)(is)\b"),
+    re.compile(r"(?i) ('t)(?#X)(was)\b"),
+]
+
+
+def ptb_tokenize(text):
+    """
+    Penn Treebank style tokenization of a sentence
+    :param text: str : sentence to be tokenized
+    :return: tokenized sentence (str), tokens separated by single spaces
+    """
+
+    for regexp, substitution in _PTB_STARTING_QUOTES:
+        text = regexp.sub(substitution, text)
+
+    for regexp, substitution in _PTB_PUNCTUATION:
+        text = regexp.sub(substitution, text)
+
+    for regexp, substitution in _PTB_PARENS:
+        text = regexp.sub(substitution, text)
+
+    text = " " + text + " "
+
+    for regexp, substitution in _PTB_ENDING_QUOTES:
+        text = regexp.sub(substitution, text)
+
+    for regexp in _PTB_CONTRACTIONS:
+        text = regexp.sub(r" \1 \2 ", text)
+
+    return " ".join(text.split())
+
+
+class Normalizer(object):
+    """
+    Normalization applied once per sentence before all metrics.
+    Steps run in the order: unicode normalization, PTB tokenization or
+    punctuation splitting, lowercasing, whitespace collapsing.
+    """
+
+    def __init__(self, lowercase=False, punct=False,
+                 unicode_form=None, ptb=False, cache=True):
+        """
+        :param lowercase: bool : lowercase sentences
+        :param punct: bool : split ASCII punctuation from words
+        :param unicode_form: str : unicode normalization form
+                                   (NFC, NFKC, NFD or NFKD), None to skip
+        :param ptb: bool : Penn Treebank style tokenization
+        :param cache: bool : memoize normalized sentences, repeated
+                             references and hypotheses are processed once
+        """
+
+        if unicode_form is not None and \
+                unicode_form not in ("NFC", "NFKC", "NFD", "NFKD"):
+            raise ValueError("Unknown unicode form %s" % unicode_form)
+
+        self.lowercase = lowercase
+        self.punct = punct
+        self.unicode_form = unicode_form
+        self.ptb = ptb
+        self._cache = {} if cache else None
+
+    def enabled(self):
+        return bool(self.lowercase or self.punct or
+                    self.unicode_form or self.ptb)
+
+    def _normalize(self, sentence):
+        if self.unicode_form is not None:
+            sentence = unicodedata.normalize(self.unicode_form, sentence)
+
+        if self.ptb:
+            sentence = ptb_tokenize(sentence)
+        elif self.punct:
+            sentence = sentence.translate(_PUNCT_TABLE)
+
+        if self.lowercase:
+            sentence = sentence.lower()
+
+        return " ".join(sentence.split())
+
+    def __call__(self, sentence):
+        if self._cache is None:
+            return self._normalize(sentence)
+
+        normalized = self._cache.get(sentence)
+
+        if normalized is None:
+            normalized = self._cache[sentence] = self._normalize(sentence)
+
+        return normalized
+
+    def batch(self, sentences):
+        """
+        Normalize a list of sentences, e.g. all lines of a file
+        :param sentences: list of str
+        :return: list of str
+        """
+
+        return [self(sentence) for sentence in sentences]
+
+    def apply(self, inputs):
+        """
+        Normalize the hypothesis or reference dict used by the scorers
+        :param inputs: dict : id -> list of str
+        :return: dict : id -> list of normalized str
+        """
+
+        return dict((k, self.batch(v)) for k, v in inputs.items())
@@ -6,6 +6,58 @@ from __future__ import print_function
 
 import numpy as np
 
+from collections import defaultdict
+
+from Metrics.bleu.bleu_scorer import precook
+
+
+# tokens that close a sentence when no explicit separator is given
+_SENT_END = frozenset([".", "!", "?"])
+
+
+def _popcount(x):
+    return bin(x).count("1")
+
+
+def _match_masks(tokens):
+    """
+    Builds the bit-parallel match vectors of a tokenized string: bit i of
+    masks[w] is set iff tokens[i] == w
+    :param tokens : list of str : tokens of the string
+    :returns: masks (dict)
+    """
+
+    masks = {}
+
+    for i, token in enumerate(tokens):
+        masks[token] = masks.get(token, 0) | (1 << i)
+
+    return masks
+
+
+def _lcs_rows(masks, length, sub):
+    """
+    Bit-parallel LCS (Allison-Dix / Hyyro): returns the row vector after
+    each token of `sub`. A zero bit j of row i marks a +1 step of the DP
+    table between columns j and j + 1, so the LCS of the first i tokens of
+    `sub` and the first j tokens of the string is j - popcount(row & (2^j - 1))
+    :param masks : dict : match vectors of the string from _match_masks
+    :param length : int : number of tokens of the string
+    :param sub : list of str : tokens of the other string
+    :returns: rows (list of int), len(sub) + 1 rows
+    """
+
+    full = (1 << length) - 1
+    row = full
+    rows = [row]
+
+    for token in sub:
+        match = row & masks.get(token, 0)
+        row = ((row + match) | (row - match)) & full
+        rows.append(row)
+
+    return rows
+
 
 def _lcs(string, sub):
     """
@@ -18,80 +70,540 @@ def _lcs(string, sub):
     if len(string) < len(sub):
         sub, string = string, sub
 
-    str_len, sub_len = len(string), len(sub)
-    lengths = [[0 for _ in range(sub_len + 1)] for _ in range(str_len + 1)]
+    # bit vectors run over the longer string, the loop over the shorter one
+    row = _lcs_rows(_match_masks(string), len(string), sub)[-1]
+
+    return len(string) - _popcount(row)
+
+
+def _cooked_lcs(cooked, other):
+    """
+    Same as _lcs for two cooked sentences of Rouge, the match vectors of
+    a sentence are built once and kept in its cooked dict
+    """
+
+    if len(cooked["tokens"]) < len(other["tokens"]):
+        cooked, other = other, cooked
+
+    masks = cooked.get("masks")
+
+    if masks is None:
+        masks = cooked["masks"] = _match_masks(cooked["tokens"])
+
+    row = _lcs_rows(masks, len(cooked["tokens"]), other["tokens"])[-1]
+
+    return len(cooked["tokens"]) - _popcount(row)
+
+
+def _cooked_types(cooked):
+    """
+    Token set and number of repeated tokens of a cooked sentence of Rouge,
+    built once and kept in its cooked dict
+    """
+
+    types = cooked.get("types")
+
+    if types is None:
+        types_set = frozenset(cooked["tokens"])
+        types = cooked["types"] = \
+            types_set, len(cooked["tokens"]) - len(types_set)
+
+    return types
+
+
+def _lcs_bound(cooked, other):
+    """
+    Upper bound of the LCS of two cooked sentences of Rouge: the token types
+    of `cooked` found in `other`, plus the repeated tokens of `cooked`. This
+    is at least their unigram overlap, and only the token set of `cooked`
+    is built, which is shared by all the sentences it is compared with.
+    """
+
+    types, repeats = _cooked_types(cooked)
+
+    return len(types.intersection(other["tokens"])) + repeats
+
+
+def _lcs_hits(string, masks, sub):
+    """
+    Positions in `string` of one LCS between `string` and `sub`,
+    recovered by tracing back through the bit-parallel rows
+    :param string : list of str : tokens of the string
+    :param masks : dict : match vectors of the string from _match_masks
+    :param sub : list of str : tokens of the other string
+    :returns: hits (list of int)
+    """
+
+    rows = _lcs_rows(masks, len(string), sub)
+
+    def table(i, j):
+        return j - _popcount(rows[i] & ((1 << j) - 1))
 
-    for j in range(1, sub_len + 1):
-        for i in range(1, str_len + 1):
+    hits = []
+    i, j = len(sub), len(string)
+
+    while i > 0 and j > 0:
+        if sub[i - 1] == string[j - 1]:
+            hits.append(j - 1)
+            i -= 1
+            j -= 1
+        elif table(i - 1, j) > table(i, j - 1):
+            i -= 1
+        else:
+            j -= 1
+
+    return hits
+
+
+def _split_sentences(text, sep=None):
+    """
+    Splits a summary into tokenized sentences
+    :param text : str : summary to be split
+    :param sep : str : sentence separator, if None sentences end
+                       after ".", "!" or "?" tokens
+    :returns: sentences (list of list of str)
+    """
+
+    if sep is not None:
+        return [sent.split() for sent in text.split(sep) if sent.strip()]
+
+    sentences = []
+    current = []
+
+    for token in text.split():
+        current.append(token)
+
+        if token in _SENT_END:
+            sentences.append(current)
+            current = []
+
+    if current:
+        sentences.append(current)
+
+    return sentences
+
+
+def _union_lcs_hits(ref_sents, cand_sents):
+    """
+    Number of summary-level union-LCS matches between two summaries, where
+    every token may be matched at most as often as it occurs on both sides
+    :param ref_sents : list of list of str : sentences of the reference
+    :param cand_sents : list of list of str : sentences of the candidate
+    :returns: hits (int)
+    """
+
+    ref_counts = defaultdict(int)
+    cand_counts = defaultdict(int)
+
+    for sent in ref_sents:
+        for token in sent:
+            ref_counts[token] += 1
+
+    for sent in cand_sents:
+        for token in sent:
+            cand_counts[token] += 1
+
+    hits = 0
+
+    for ref_sent in ref_sents:
+        # the match vectors of a reference sentence are shared
+        # by every candidate sentence it is aligned with
+        masks = _match_masks(ref_sent)
+        union = set()
+
+        for cand_sent in cand_sents:
+            union.update(_lcs_hits(ref_sent, masks, cand_sent))
+
+        for pos in sorted(union):
+            token = ref_sent[pos]
+
+            if ref_counts[token] > 0 and cand_counts[token] > 0:
+                hits += 1
+                ref_counts[token] -= 1
+                cand_counts[token] -= 1
+
+    return hits
+
+
+def _wlcs(string, sub, alpha=1.2):
+    """
+    Computes weighted longest common subsequence (WLCS) for a pair of
+    tokenized strings, using the weighting function f(k) = k ** alpha
+    :param string : list of str : tokens of the reference
+    :param sub : list of str : tokens of the candidate
+    :param alpha : float : weighting factor, must be > 1 to favour runs
+    :returns: score (float): WLCS score between the two strings
+    """
+
+    sub_len = len(sub)
+    prev_c = [0.0 for _ in range(sub_len + 1)]
+    prev_w = [0 for _ in range(sub_len + 1)]
+
+    # only two rows of the c/w tables are kept alive at a time
+    for i in range(1, len(string) + 1):
+        cur_c = [0.0 for _ in range(sub_len + 1)]
+        cur_w = [0 for _ in range(sub_len + 1)]
+
+        for j in range(1, sub_len + 1):
             if string[i - 1] == sub[j - 1]:
-                lengths[i][j] = lengths[i - 1][j - 1] + 1
+                k = prev_w[j - 1]
+                cur_c[j] = prev_c[j - 1] + (k + 1) ** alpha - k ** alpha
+                cur_w[j] = k + 1
+            elif prev_c[j] > cur_c[j - 1]:
+                cur_c[j] = prev_c[j]
             else:
-                lengths[i][j] = max(lengths[i - 1][j], lengths[i][j - 1])
+                cur_c[j] = cur_c[j - 1]
+
+        prev_c, prev_w = cur_c, cur_w
+
+    return prev_c[sub_len]
+
 
-    return lengths[str_len][sub_len]
+def _ngrams(sentence, n=2):
+    """
+    Splits the n-gram counts cooked by BLEU into one dict per n-gram order
+    :param sentence: str : sentence to be converted into ngrams
+    :param n: int : highest n-gram order
+    :returns: counts (list of dict), totals (list of int), indexed by order - 1
+    """
+
+    _, cooked = precook(sentence, n)
+    counts = [{} for _ in range(n)]
+    totals = [0 for _ in range(n)]
+
+    for ngram, count in cooked.items():
+        counts[len(ngram) - 1][ngram] = count
+        totals[len(ngram) - 1] += count
+
+    return counts, totals
+
+
+def _skip_bigrams(tokens, skip=4, unigram=False):
+    """
+    Counts skip-bigrams (ordered word pairs with at most `skip` words in
+    between) of a tokenized string
+    :param tokens: list of str : tokens of the sentence
+    :param skip: int : maximum skip distance, None or negative for unlimited
+    :param unigram: bool : also count unigrams (ROUGE-SU)
+    :returns: counts (dict), total (int)
+    """
+
+    counts = defaultdict(int)
+    tokens_len = len(tokens)
+
+    for i, word in enumerate(tokens):
+        if skip is None or skip < 0:
+            end = tokens_len
+        else:
+            end = min(tokens_len, i + skip + 2)
+
+        for j in range(i + 1, end):
+            counts[(word, tokens[j])] += 1
+
+        if unigram:
+            counts[(word,)] += 1
+
+    return counts, sum(counts.values())
+
+
+def _overlap(hypo_counts, ref_counts):
+    """
+    Number of clipped matches between two count dicts
+    """
+
+    if len(hypo_counts) > len(ref_counts):
+        hypo_counts, ref_counts = ref_counts, hypo_counts
+
+    return sum(min(count, ref_counts.get(gram, 0))
+               for gram, count in hypo_counts.items())
+
+
+def _fscore(prec, rec, beta):
+    if prec != 0 and rec != 0:
+        return ((1 + beta ** 2) * prec * rec) / float(rec + beta ** 2 * prec)
+
+    return 0.0
 
 
 class Rouge(object):
     """
-    Class for computing ROUGE-L score for a set of 
-    candidate sentences for the MS COCO test set
+    Class for computing ROUGE scores for a set of
+    candidate sentences for the MS COCO test set.
+    Supported variants are "L" (ROUGE-L), "Lsum" (summary-level ROUGE-L),
+    "W" (ROUGE-W), "1" ... "9" (ROUGE-N), "S" (skip-bigram) and "SU"
+    (skip-bigram plus unigram)
     """
 
-    def __init__(self):
+    def __init__(self, variants=("L",), beta=1.2, alpha=1.2,
+                 skip=4, aggregate="max", sentence_sep=None):
         # vrama91: updated the value below based on discussion with Hovey
-        self.beta = 1.2
+        self.beta = beta
+        # weighting factor of ROUGE-W
+        self.alpha = alpha
+        # maximum skip distance of ROUGE-S/SU
+        self.skip = skip
+        # sentence separator of ROUGE-Lsum
+        self.sentence_sep = sentence_sep
 
-    def calc_score(self, candidate, refs):
+        if aggregate not in ("max", "avg"):
+            raise ValueError("Unknown aggregate option %s" % aggregate)
+
+        self.aggregate = aggregate
+        self.variants = []
+        self.n = 0
+
+        for variant in variants:
+            variant = str(variant).upper()
+
+            if variant.isdigit() and int(variant) > 0:
+                self.n = max(self.n, int(variant))
+            elif variant not in ("L", "LSUM", "W", "S", "SU"):
+                raise ValueError("Unknown ROUGE variant %s" % variant)
+
+            self.variants.append(variant)
+
+        # with max aggregation ROUGE-L only needs the best precision and
+        # recall, so references that cannot improve them are skipped
+        self._prune_lcs = aggregate == "max" and "L" in self.variants
+        self._pair_variants = [variant for variant in self.variants
+                               if not (self._prune_lcs and variant == "L")]
+
+    def metrics(self):
+        """
+        Names of the scores returned by calc_score/compute_score, in order
+        """
+
+        names = []
+        skip = "*" if self.skip is None or self.skip < 0 else self.skip
+
+        for variant in self.variants:
+            if variant == "W":
+                names.append("ROUGE-W-%g" % self.alpha)
+            elif variant in ("S", "SU"):
+                names.append("ROUGE-%s%s" % (variant, skip))
+            elif variant == "LSUM":
+                names.append("ROUGE-Lsum")
+            else:
+                names.append("ROUGE-%s" % variant)
+
+        return names
+
+    def _reduce(self, prec, rec):
+        if self.aggregate == "max":
+            return _fscore(max(prec), max(rec), self.beta)
+
+        return _fscore(np.mean(prec), np.mean(rec), self.beta)
+
+    def _key(self, sentence):
+        # every ROUGE variant splits on whitespace, so sentences that only
+        # differ in spacing share their cooked form and pairwise scores
+        if self.sentence_sep is not None and \
+                self.sentence_sep.split() != [self.sentence_sep]:
+            return sentence
+
+        return " ".join(sentence.split())
+
+    def _cook(self, sentence):
+        """
+        Everything the configured variants need to know about one sentence
+        """
+
+        cooked = {"tokens": sentence.split()}
+
+        if self.n:
+            cooked["ngrams"] = _ngrams(sentence, self.n)
+
+        for variant in set(self.variants) & set(["S", "SU"]):
+            cooked[variant] = _skip_bigrams(
+                cooked["tokens"], self.skip, variant == "SU")
+
+        if "LSUM" in self.variants:
+            cooked["sents"] = _split_sentences(sentence, self.sentence_sep)
+
+        return cooked
+
+    def _pair_stats(self, cooked_c, cooked_r):
+        """
+        Precision and recall of each variant for one (candidate, reference) pair
+        """
+
+        token_c = cooked_c["tokens"]
+        token_r = cooked_r["tokens"]
+        stats = []
+
+        for variant in self._pair_variants:
+            if variant == "L":
+                # compute the longest common subsequence
+                lcs = _cooked_lcs(cooked_r, cooked_c)
+                prec = lcs / float(len(token_c))
+                rec = lcs / float(len(token_r))
+            elif variant == "LSUM":
+                sents_c = cooked_c["sents"]
+                sents_r = cooked_r["sents"]
+                len_c = sum(len(sent) for sent in sents_c)
+                len_r = sum(len(sent) for sent in sents_r)
+                hits = _union_lcs_hits(sents_r, sents_c)
+                prec = hits / float(len_c) if len_c else 0.0
+                rec = hits / float(len_r) if len_r else 0.0
+            elif variant == "W":
+                inv = 1.0 / self.alpha
+                wlcs = _wlcs(token_r, token_c, self.alpha)
+                prec = (wlcs / len(token_c) ** self.alpha) ** inv \
+                    if token_c else 0.0
+                rec = (wlcs / len(token_r) ** self.alpha) ** inv \
+                    if token_r else 0.0
+            elif variant in ("S", "SU"):
+                counts_c, total_c = cooked_c[variant]
+                counts_r, total_r = cooked_r[variant]
+                hits = _overlap(counts_c, counts_r)
+                prec = hits / float(total_c) if total_c else 0.0
+                rec = hits / float(total_r) if total_r else 0.0
+            else:
+                k = int(variant) - 1
+                ngram_c, total_c = cooked_c["ngrams"]
+                ngram_r, total_r = cooked_r["ngrams"]
+                hits = _overlap(ngram_c[k], ngram_r[k])
+                prec = hits / float(total_c[k]) if total_c[k] else 0.0
+                rec = hits / float(total_r[k]) if total_r[k] else 0.0
+
+            stats.append((prec, rec))
+
+        return stats
+
+    def calc_scores(self, candidate, refs, cache=None):
         """
-        Compute ROUGE-L score given one candidate and references for an image
+        Compute all configured ROUGE scores given one candidate and references
         :param candidate: str : candidate sentence to be evaluated
         :param refs: list of str : COCO reference sentences for the particular image to be evaluated
-        :returns score: int (ROUGE-L score for the candidate evaluated against references)
+        :param cache: dict : cooked sentences and pairwise results shared
+                             across calls, repeated sentences and
+                             (candidate, reference) pairs are computed once
+        :returns scores: list of float, aligned with metrics()
         """
 
         assert(len(candidate) == 1)
         assert(len(refs) > 0)
 
-        prec = []
-        rec = []
+        if cache is None:
+            cache = {}
+
+        key_c = self._key(candidate[0])
+        cooked_c = cache.get(key_c)
+
+        # the candidate is cooked once and shared across references
+        if cooked_c is None:
+            cooked_c = cache[key_c] = self._cook(candidate[0])
 
-        # split into tokens
-        token_c = candidate[0].split()
+        keys_r = []
+        cooked_rs = []
 
         for reference in refs:
-            # split into tokens
-            token_r = reference.split()
-            # compute the longest common subsequence
-            lcs = _lcs(token_r, token_c)
-            prec.append(lcs / float(len(token_c)))
-            rec.append(lcs / float(len(token_r)))
-
-        prec_max = max(prec)
-        rec_max = max(rec)
-
-        if prec_max != 0 and rec_max != 0:
-            score = ((1 + self.beta ** 2) * prec_max * rec_max) / \
-                float(rec_max + self.beta ** 2 * prec_max)
-        else:
-            score = 0.0
+            key_r = self._key(reference)
+            cooked_r = cache.get(key_r)
 
-        return score
+            if cooked_r is None:
+                cooked_r = cache[key_r] = self._cook(reference)
 
-    def compute_score(self, gts, res):
+            keys_r.append(key_r)
+            cooked_rs.append(cooked_r)
+
+        pairs = []
+
+        if self._pair_variants:
+            for key_r, cooked_r in zip(keys_r, cooked_rs):
+                stats = cache.get((key_c, key_r))
+
+                if stats is None:
+                    stats = cache[(key_c, key_r)] = \
+                        self._pair_stats(cooked_c, cooked_r)
+
+                pairs.append(stats)
+
+        scores = []
+        i = 0
+
+        for variant in self.variants:
+            if self._prune_lcs and variant == "L":
+                prec_max, rec_max = self._lcs_max(
+                    key_c, cooked_c, keys_r, cooked_rs, cache)
+                scores.append(_fscore(prec_max, rec_max, self.beta))
+            else:
+                scores.append(self._reduce([stats[i][0] for stats in pairs],
+                                           [stats[i][1] for stats in pairs]))
+                i += 1
+
+        return scores
+
+    def _lcs_max(self, key_c, cooked_c, keys_r, cooked_rs, cache):
         """
-        Computes Rouge-L score given a set of reference and 
-        candidate sentences for the dataset.
+        Best ROUGE-L precision and recall over the references. The LCS is
+        at most the unigram overlap of the two sentences, itself bounded by
+        _lcs_bound, so a reference is skipped when that bound can improve
+        neither the best precision nor the best recall. References with the highest bound are
+        tried first, and the search stops when no bound left can improve.
+        :returns: prec_max (float), rec_max (float)
+        """
+
+        len_c = float(len(cooked_c["tokens"]))
+        len_rs = [float(len(cooked_r["tokens"])) for cooked_r in cooked_rs]
+        len_min = min(len_rs)
+        bounds = [_lcs_bound(cooked_c, cooked_r) for cooked_r in cooked_rs]
+        prec_max = 0.0
+        rec_max = 0.0
+
+        for i in sorted(range(len(bounds)), key=bounds.__getitem__,
+                        reverse=True):
+            bound = bounds[i]
+
+            if bound / len_c <= prec_max:
+                if bound / len_min <= rec_max:
+                    break
+
+                if bound / len_rs[i] <= rec_max:
+                    continue
+
+            lcs = cache.get(("L", key_c, keys_r[i]))
+
+            if lcs is None:
+                # compute the longest common subsequence
+                lcs = cache[("L", key_c, keys_r[i])] = \
+                    _cooked_lcs(cooked_rs[i], cooked_c)
+
+            prec_max = max(prec_max, lcs / len_c)
+            rec_max = max(rec_max, lcs / len_rs[i])
+
+        return prec_max, rec_max
+
+    def calc_score(self, candidate, refs):
+        """
+        Compute ROUGE score given one candidate and references for an image
+        :param candidate: str : candidate sentence to be evaluated
+        :param refs: list of str : COCO reference sentences for the particular image to be evaluated
+        :returns score: float (ROUGE score for the candidate evaluated against references),
+                        or a list of float if more than one variant is configured
+        """
+
+        scores = self.calc_scores(candidate, refs)
+
+        if len(scores) == 1:
+            return scores[0]
+
+        return scores
+
+    def compute_stats(self, gts, res):
+        """
+        Per-segment ROUGE scores, mergeable with merge_stats
         :param gts: dict : ground_truth
         :param res: dict : results of predict
-        :returns: average_score: float (mean ROUGE-L score)
+        :returns: list of list of float, aligned with metrics()
         """
 
         score = []
+        cache = {}
 
         for idx in sorted(gts.keys()):
             hypo = res[idx]
             ref = gts[idx]
-            score.append(self.calc_score(hypo, ref))
 
             # Sanity check
             assert(isinstance(hypo, list))
@@ -99,10 +611,37 @@ class Rouge(object):
             assert(len(hypo) == 1)
             assert(len(ref) > 0)
 
-        average_score = np.mean(np.array(score))
+            score.append(self.calc_scores(hypo, ref, cache))
+
+        return score
+
+    def merge_stats(self, stats):
+        """
+        Averages the concatenation of statistics from compute_stats
+        :returns: average_score: float (mean ROUGE score), or a list of
+                  float if more than one variant is configured
+        """
+
+        score = np.array(stats)
+        average_score = np.mean(score, axis=0)
 
         # convert to percentage
-        return 100 * average_score, np.array(score)
+        if len(self.variants) == 1:
+            return 100 * average_score[0], score[:, 0]
+
+        return list(100 * average_score), score
+
+    def compute_score(self, gts, res):
+        """
+        Computes ROUGE score given a set of reference and
+        candidate sentences for the dataset.
+        :param gts: dict : ground_truth
+        :param res: dict : results of predict
+        :returns: average_score: float (mean ROUGE score), or a list of
+                  float if more than one variant is configured
+        """
+
+        return self.merge_stats(self.compute_stats(gts, res))
 
     @staticmethod
     def method():
@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import time
+import numpy as np
+
+from collections import deque
+
+from Metrics.bleu.bleu_scorer import BleuScorer, closest_reflen, \
+    cook_refs, cook_test
+from Metrics.cider.cider_scorer import CiderScorer, precook
+from Metrics.rouge.rouge import Rouge
+
+
+class _Stats(object):
+    """Additive sufficient statistics of a set of segments"""
+
+    __slots__ = "count", "testlen", "reflen", "guess", "correct", \
+        "rouge", "cider"
+
+    def __init__(self, n):
+        self.count = 0
+        self.testlen = 0
+        self.reflen = 0
+        self.guess = [0 for _ in range(n)]
+        self.correct = [0 for _ in range(n)]
+        self.rouge = 0.0
+        self.cider = 0.0
+
+    def update(self, other, sign=1):
+        self.count += sign * other.count
+        self.testlen += sign * other.testlen
+        self.reflen += sign * other.reflen
+        self.rouge += sign * other.rouge
+        self.cider += sign * other.cider
+
+        for k in range(len(self.guess)):
+            self.guess[k] += sign * other.guess[k]
+            self.correct[k] += sign * other.correct[k]
+
+
+class _Bucket(_Stats):
+
+    __slots__ = "index", "document_frequency"
+
+    def __init__(self, n, index):
+        super(_Bucket, self).__init__(n)
+        self.index = index
+        # document frequency contributed by the references of this bucket
+        self.document_frequency = {}
+
+
+class WindowTracker(object):
+    """
+    Online BLEU, ROUGE-L and CIDEr over a sliding time window.
+    Events are grouped into time buckets of `bucket` seconds and the window
+    keeps the last `window` seconds of buckets. Every event is scored once
+    on arrival and only additive statistics are kept, so appending and
+    expiring events costs a constant amortized time.
+    CIDEr uses the document frequency of the references in the window at
+    the time an event arrives, rather than rescoring the whole window when
+    the document frequency changes. While the window is cold this is a poor
+    estimate, e.g. an event arriving in an empty window always scores 0;
+    pass a fixed table as `df` (e.g. from load_doc_freq) to avoid it.
+    Events arriving out of order are counted in the bucket of their
+    timestamp, events older than the window are dropped.
+    METEOR is not tracked, its statistics can only be scored by the jar.
+    """
+
+    def __init__(self, window=3600, bucket=60, n=4, bleu=True,
+                 rouge=True, cider=True, sigma=6.0, df=None,
+                 normalizer=None):
+        """
+        :param window: float : length of the window in seconds
+        :param bucket: float : length of a time bucket in seconds
+        :param n: int : highest n-gram order of BLEU and CIDEr
+        :param sigma: float : standard deviation of the CIDEr-D length penalty
+        :param df: dict : fixed CIDEr document frequency table, as returned by
+                   load_doc_freq, None to use the references in the window
+        :param normalizer: Normalizer : applied to every sentence, optional
+        """
+
+        if bucket <= 0 or window < bucket:
+            raise ValueError("window: %s must be at least one bucket: %s"
+                             % (window, bucket))
+
+        self.n = n
+        self.bucket = bucket
+        self.num_buckets = int(np.ceil(window / float(bucket)))
+        self.bleu = bleu
+        self.rouge = Rouge() if rouge else None
+        self.cider = cider
+        self.sigma = sigma
+        self.df = df
+        self.normalizer = normalizer
+        # buckets in index order, and the same buckets by index
+        self.buckets = deque()
+        self.bucket_index = {}
+        self.total = _Stats(n)
+        self.document_frequency = {}
+        # index of the oldest bucket in the window, it never moves back
+        self.oldest = None
+
+    def metrics(self):
+        metrics = []
+
+        if self.bleu:
+            metrics.extend("BLEU-%d" % i for i in range(1, self.n + 1))
+
+        if self.rouge is not None:
+            metrics.append("ROUGE-L")
+
+        if self.cider:
+            metrics.append("CIDEr")
+
+        return metrics
+
+    def _bucket(self, timestamp):
+        index = int(timestamp // self.bucket)
+        self.expire(timestamp)
+
+        if index < self.oldest:
+            return None
+
+        bucket = self.bucket_index.get(index)
+
+        if bucket is None:
+            bucket = self.bucket_index[index] = _Bucket(self.n, index)
+            # late events are usually close to the newest bucket
+            position = len(self.buckets)
+
+            while position and self.buckets[position - 1].index > index:
+                position -= 1
+
+            self.buckets.insert(position, bucket)
+
+        return bucket
+
+    def expire(self, timestamp=None):
+        """
+        Drop the buckets that left the window at `timestamp` (default: now)
+        """
+
+        if timestamp is None:
+            timestamp = time.time()
+
+        oldest = int(timestamp // self.bucket) - self.num_buckets + 1
+
+        if self.oldest is None or oldest > self.oldest:
+            self.oldest = oldest
+
+        while self.buckets and self.buckets[0].index < self.oldest:
+            expired = self.buckets.popleft()
+            del self.bucket_index[expired.index]
+            self.total.update(expired, -1)
+
+            for ngram, df in expired.document_frequency.items():
+                df = self.document_frequency[ngram] - df
+
+                if df:
+                    self.document_frequency[ngram] = df
+                else:
+                    del self.document_frequency[ngram]
+
+    def add(self, hypo, refs, timestamp=None):
+        """
+        Append one (hypothesis, references) event
+        :param hypo: str : hypothesis
+        :param refs: list of str : references
+        :param timestamp: float : time of the event, default now
+        :return: bool : False if the event is older than the window and
+                        was dropped
+        """
+
+        assert(len(refs) > 0)
+
+        if timestamp is None:
+            timestamp = time.time()
+
+        if self.normalizer is not None:
+            hypo = self.normalizer(hypo)
+            refs = self.normalizer.batch(refs)
+
+        bucket = self._bucket(timestamp)
+
+        if bucket is None:
+            return False
+
+        event = _Stats(self.n)
+        event.count = 1
+
+        if self.bleu:
+            comps = cook_test(hypo, cook_refs(refs, n=self.n), n=self.n)
+            event.testlen = comps["testlen"]
+            event.reflen = closest_reflen(comps["reflen"], comps["testlen"])
+            event.guess = comps["guess"]
+            event.correct = comps["correct"]
+
+        if self.rouge is not None:
+            event.rouge = self.rouge.calc_score([hypo], refs)
+
+        if self.cider and self.df is not None:
+            cider_scorer = CiderScorer(hypo, refs, n=self.n,
+                                       sigma=self.sigma, df=self.df)
+            event.cider = float(cider_scorer.compute_cider()[0])
+        elif self.cider:
+            for ngram in set(ngram for ref in refs
+                             for ngram in precook(ref, self.n)):
+                self.document_frequency[ngram] = \
+                    self.document_frequency.get(ngram, 0) + 1
+                bucket.document_frequency[ngram] = \
+                    bucket.document_frequency.get(ngram, 0) + 1
+
+            cider_scorer = CiderScorer(
+                hypo, refs, n=self.n, sigma=self.sigma,
+                df={"document_frequency": self.document_frequency,
+                    "ref_len": np.log(float(self.total.count + 1))})
+            event.cider = float(cider_scorer.compute_cider()[0])
+
+        bucket.update(event)
+        self.total.update(event)
+
+        return True
+
+    def _scores(self, stats):
+        scores = {}
+
+        if not stats.count:
+            return scores
+
+        if self.bleu:
+            # the summed counts are scored as one segment, which gives
+            # the corpus BLEU of the segments they were summed from
+            bleu_scorer = BleuScorer(n=self.n)
+            bleu_scorer.ctest.append({"testlen": stats.testlen,
+                                      "reflen": [stats.reflen],
+                                      "guess": stats.guess,
+                                      "correct": stats.correct})
+            bleus, _ = bleu_scorer.compute_score(option="closest")
+
+            for i, bleu in enumerate(bleus):
+                scores["BLEU-%d" % (i + 1)] = bleu
+
+        if self.rouge is not None:
+            scores["ROUGE-L"] = 100 * stats.rouge / stats.count
+
+        if self.cider:
+            scores["CIDEr"] = stats.cider / stats.count
+
+        return scores
+
+    def report(self, timestamp=None):
+        """
+        Scores over the window at `timestamp` (default: now)
+        :return: dict : metric -> score, empty if the window has no events
+        """
+
+        self.expire(timestamp)
+
+        return self._scores(self.total)
+
+    def report_buckets(self, timestamp=None):
+        """
+        Scores of every time bucket in the window at `timestamp` (default: now)
+        :return: list of (bucket start time, dict : metric -> score)
+        """
+
+        self.expire(timestamp)
+
+        return [(bucket.index * self.bucket, self._scores(bucket))
+                for bucket in self.buckets]
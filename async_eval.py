@@ -0,0 +1,82 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import asyncio
+import functools
+
+from run_eval import Evaluate
+from Metrics.meteor.meteor_async import AsyncMeteor
+
+
+class AsyncEvaluate(object):
+    """
+    asyncio front end of Evaluate. BLEU, ROUGE and CIDEr run in an executor
+    and METEOR talks to an asyncio subprocess, so evaluation never blocks
+    the event loop. At most `max_concurrency` requests are evaluated at a
+    time, further requests wait for a free slot.
+    """
+
+    def __init__(self, meteor=True, max_concurrency=8,
+                 executor=None, **kwargs):
+        """
+        :param meteor: bool : use METEOR as metric
+        :param max_concurrency: int : number of requests evaluated at a time
+        :param executor: concurrent.futures.Executor : runs the CPU-bound
+                         metrics, None uses the default executor of the loop
+        :param kwargs: other options of Evaluate
+        """
+
+        if max_concurrency <= 0:
+            raise ValueError("max_concurrency: %d must be a positive "
+                             "integer." % max_concurrency)
+
+        self.evaluator = Evaluate(meteor=False, **kwargs)
+        # a long running service sees an unbounded set of sentences, so they
+        # are not memoized across requests
+        self.evaluator.normalizer = self.evaluator.stream_normalizer
+        self.meteor = AsyncMeteor() if meteor else None
+        self.max_concurrency = max_concurrency
+        self.executor = executor
+        self.semaphore = None
+
+    async def evaluate(self, hypos, refs):
+        """
+        Evaluate one request
+        :param hypos: dict : key -> hypothesis str
+        :param refs: dict : key -> list of reference str
+        :return: final_scores (dict)
+        """
+
+        # the semaphore is created here so that it belongs to the running loop
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        loop = asyncio.get_running_loop()
+
+        async with self.semaphore:
+            refs, hypos = await loop.run_in_executor(
+                self.executor, functools.partial(
+                    self.evaluator.load, True, refs=refs, hypos=hypos))
+
+            tasks = [loop.run_in_executor(
+                self.executor, self.evaluator.score, refs, hypos)]
+
+            if self.meteor is not None:
+                tasks.append(self.meteor.compute_score(refs, hypos))
+
+            results = await asyncio.gather(*tasks)
+
+        final_scores = dict(results[0])
+
+        if self.meteor is not None:
+            final_scores["METEOR"] = results[1][0]
+
+        return final_scores
+
+    async def close(self):
+        if self.meteor is not None:
+            await self.meteor.close()
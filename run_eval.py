@@ -5,14 +5,21 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import os
 import sys
+import gzip
+import pickle
 import argparse
+import itertools
 import collections
 
 from Metrics.bleu.bleu import Bleu
 from Metrics.rouge.rouge import Rouge
 from Metrics.meteor.meteor import Meteor
 from Metrics.cider.cider import Cider
+from Metrics.cider.cider_scorer import build_doc_freq, doc_freq_digest, \
+    save_doc_freq
+from Metrics.normalize import Normalizer
 
 
 def parse_args():
@@ -22,43 +29,156 @@ def parse_args():
     )
 
     # input files
-    parser.add_argument("--hypos", type=str, required=True,
+    parser.add_argument("--hypos", type=str, default=None,
                         help="Path of hypothesis file")
-    parser.add_argument("--refs", type=str, required=True, nargs="+",
+    parser.add_argument("--refs", type=str, default=None, nargs="+",
                         help="Path of reference file")
+    parser.add_argument("--groups", type=str, default=None,
+                        help="Path of a file with the group label of each "
+                             "hypothesis, to also report scores per group")
+
+    # sharded evaluation
+    parser.add_argument("--partial", type=str, default=None,
+                        help="write the statistics of this shard to a file "
+                             "instead of printing scores")
+    parser.add_argument("--merge", type=str, default=None, nargs="+",
+                        help="merge statistics files written by --partial")
+
+    # checkpointing
+    parser.add_argument("--checkpoint", type=str, default=None,
+                        help="periodically save the statistics of the "
+                             "evaluated segments to this file")
+    parser.add_argument("--checkpoint_every", type=int, default=10000,
+                        help="number of segments between checkpoints")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue from the last checkpoint")
 
     # metrics
     parser.add_argument("-n", "--ngram", type=int, default=4,
                         help="calculate BLEU-n score")
     parser.add_argument("-lc", "--lowercase", action="store_true",
                         help="evaluation in lowercase mode")
+    parser.add_argument("--punct", action="store_true",
+                        help="split punctuation from words")
+    parser.add_argument("--ptb", action="store_true",
+                        help="Penn Treebank style tokenization")
+    parser.add_argument("--unicode", type=str, default=None,
+                        choices=["NFC", "NFKC", "NFD", "NFKD"],
+                        help="unicode normalization form")
     parser.add_argument("-nB", "--no_BLEU", action="store_true",
                         help="do not use BLEU as metric")
     parser.add_argument("-nM", "--no_METEOR", action="store_true",
                         help="do not use METEOR as metric")
     parser.add_argument("-nR", "--no_ROUGE", action="store_true",
-                        help="do not use ROUGE-L as metric")
+                        help="do not use ROUGE as metric")
+    parser.add_argument("-rv", "--rouge_variants", type=str, nargs="+",
+                        default=["L"],
+                        help="ROUGE variants: L, W, S, SU or an n-gram "
+                             "order for ROUGE-N")
+    parser.add_argument("--rouge_aggregate", type=str, default="max",
+                        choices=["max", "avg"],
+                        help="multi-reference aggregation of ROUGE")
+    parser.add_argument("--rouge_sent_sep", type=str, default=None,
+                        help="sentence separator of ROUGE-Lsum, by default "
+                             "sentences end with . ! or ?")
     parser.add_argument("-nC", "--no_CIDEr", action="store_true",
                         help="do not use CIDEr as metric")
+    parser.add_argument("--cider_sigma", type=float, default=6.0,
+                        help="standard deviation of the CIDEr-D length "
+                             "penalty, 0 disables the penalty")
+    parser.add_argument("--cider_df", type=str, default=None,
+                        help="precomputed CIDEr document frequency table")
+    parser.add_argument("--cider_streaming", action="store_true",
+                        help="compute CIDEr in two passes over the files "
+                             "without keeping them in memory")
+    parser.add_argument("--cider_spill", type=str, default=None,
+                        help="spill the CIDEr document frequency table of "
+                             "--cider_streaming to this new sqlite file, "
+                             "removed when done")
+    parser.add_argument("--cider_df_ref_len", type=int, default=None,
+                        help="number of segments of the --cider_df table, "
+                             "for tables that do not store it (e.g. 40504 "
+                             "for coco-val-df.p)")
+    parser.add_argument("--save_cider_df", type=str, default=None,
+                        help="save the CIDEr document frequency table of "
+                             "the references and exit")
 
-    return parser.parse_args()
+    args = parser.parse_args()
 
+    if args.merge is None:
+        if args.refs is None:
+            parser.error("argument --refs is required")
 
-def _lc(inputs):
-    output = {}
+        if args.hypos is None and args.save_cider_df is None:
+            parser.error("argument --hypos is required")
 
-    for k, v in inputs.items():
-        output[k] = [s.lower() for s in v]
+    if args.cider_streaming and (args.partial or args.merge or
+                                 args.checkpoint or args.groups):
+        parser.error("argument --cider_streaming cannot be used with "
+                     "--partial, --merge, --checkpoint or --groups")
 
-    return output
+    if args.cider_spill is not None and not args.cider_streaming:
+        parser.error("argument --cider_spill requires --cider_streaming")
+
+    if args.groups is not None and \
+            (args.partial or args.merge or args.checkpoint):
+        parser.error("argument --groups cannot be used with --partial, "
+                     "--merge or --checkpoint")
+
+    if args.resume and args.checkpoint is None:
+        parser.error("argument --resume requires --checkpoint")
+
+    if args.checkpoint is not None and (args.partial or args.merge):
+        parser.error("argument --checkpoint cannot be used with --partial "
+                     "or --merge")
+
+    return args
+
+
+def read_refs(refs_files):
+    refs = {}
+
+    for refs_file in refs_files:
+        with open(refs_file) as fd:
+            for ids, line in enumerate(fd):
+                if ids in refs:
+                    refs[ids].extend(line.strip().split("\t"))
+                else:
+                    refs[ids] = line.strip().split("\t")
+
+    return refs
+
+
+def read_hypos(hypos_file):
+    with open(hypos_file) as fd:
+        hypos = fd.readlines()
+
+    return {ids: [line.strip()] for ids, line in enumerate(hypos)}
+
+
+def read_groups(groups_file):
+    with open(groups_file) as fd:
+        return {ids: line.strip() for ids, line in enumerate(fd)}
 
 
 class Evaluate(object):
 
     def __init__(self, bleu=True, meteor=True,
-                 rouge=True, cider=True, n=4, lowercase=False):
-        self.lc = lowercase
+                 rouge=True, cider=True, n=4, lowercase=False,
+                 punct=False, ptb=False, unicode_form=None,
+                 rouge_variants=("L",), rouge_aggregate="max",
+                 rouge_sent_sep=None, cider_sigma=6.0, cider_df=None,
+                 cider_df_ref_len=None,
+                 cider_streaming=False, cider_spill=None):
+        self.normalizer = Normalizer(lowercase=lowercase, punct=punct,
+                                     unicode_form=unicode_form, ptb=ptb)
+        # streamed sentences are not memoized, so memory stays bounded
+        self.stream_normalizer = Normalizer(
+            lowercase=lowercase, punct=punct,
+            unicode_form=unicode_form, ptb=ptb, cache=False)
         self.scorers = []
+        self.streaming_cider = None
+        self.cider_spill = cider_spill
 
         if bleu:
             if n < 0:
@@ -71,10 +191,46 @@ class Evaluate(object):
             self.scorers.append((Meteor(), "METEOR"))
 
         if rouge:
-            self.scorers.append((Rouge(), "ROUGE-L"))
+            rouge_scorer = Rouge(variants=rouge_variants,
+                                 aggregate=rouge_aggregate,
+                                 sentence_sep=rouge_sent_sep)
+            metric = rouge_scorer.metrics()
+
+            if len(metric) == 1:
+                metric = metric[0]
+
+            self.scorers.append((rouge_scorer, metric))
 
         if cider:
-            self.scorers.append((Cider(), "CIDEr"))
+            cider_scorer = Cider(sigma=cider_sigma, df=cider_df,
+                                 df_ref_len=cider_df_ref_len)
+
+            if cider_streaming:
+                self.streaming_cider = cider_scorer
+            else:
+                self.scorers.append((cider_scorer, "CIDEr"))
+
+        # options that change scores but not the metric names, statistics
+        # files can only be merged if they were computed with the same ones
+        self.settings = {
+            "lowercase": lowercase, "punct": punct,
+            "ptb": ptb, "unicode_form": unicode_form,
+            "rouge_aggregate": rouge_aggregate,
+            "rouge_sent_sep": rouge_sent_sep,
+            "cider_sigma": cider_sigma,
+            # the table is identified by its content, not by its path
+            "cider_df": None if not cider else self._df_signature(
+                cider_scorer._df)}
+
+    @staticmethod
+    def _df_signature(df):
+        if df is None:
+            return None
+
+        if "digest" not in df:
+            df["digest"] = doc_freq_digest(df["document_frequency"])
+
+        return float(df["ref_len"]), df["digest"]
 
     def convert(self, data):
         if isinstance(data, basestring):
@@ -88,21 +244,115 @@ class Evaluate(object):
 
         return data
 
-    def score(self, refs, hypos):
+    def _collect(self, final_scores, metric, score):
+        if isinstance(metric, list):
+            for m, s in zip(metric, score):
+                final_scores[m] = s
+        else:
+            final_scores[metric] = score
+
+    def metrics(self):
+        metrics = [metric for _, metric in self.scorers]
+
+        if self.streaming_cider is not None:
+            metrics.append("CIDEr")
+
+        return metrics
+
+    def _score(self, refs, hypos):
         final_scores = {}
 
         for scorer, metric in self.scorers:
             score, _ = scorer.compute_score(refs, hypos)
+            self._collect(final_scores, metric, score)
 
-            if isinstance(metric, list):
-                for m, s in zip(metric, score):
-                    final_scores[m] = s
-            else:
-                final_scores[metric] = score
+        return final_scores
+
+    def score(self, refs, hypos):
+        final_scores = self._score(refs, hypos)
+
+        if self.streaming_cider is not None:
+            final_scores["CIDEr"] = self.score_streaming(
+                lambda: ((hypos[ids][0], refs[ids]) for ids in sorted(refs)))
 
         return final_scores
 
-    def evaluate(self, get_scores=True, live=False, **kwargs):
+    def stream_segments(self, refs_files, hypos_file):
+        """(hypothesis, references) of each line, read lazily"""
+        refs_fds = [open(refs_file) for refs_file in refs_files]
+
+        try:
+            with open(hypos_file) as hypos_fd:
+                fds = [hypos_fd] + refs_fds
+
+                for i, lines in enumerate(itertools.zip_longest(*fds)):
+                    if None in lines:
+                        # count the lines left in every file for the message
+                        num_lines = [i + (line is not None) +
+                                     sum(1 for _ in fd)
+                                     for line, fd in zip(lines, fds)]
+                        num_refs = [num for num in num_lines[1:]
+                                    if num != num_lines[0]]
+                        raise ValueError("test(%d)/refs(%d) mismatch!"
+                                         % (num_lines[0], num_refs[0]))
+
+                    hypo = lines[0].strip()
+                    refs = [ref for line in lines[1:]
+                            for ref in line.strip().split("\t")]
+
+                    if self.stream_normalizer.enabled():
+                        hypo = self.stream_normalizer(hypo)
+                        refs = self.stream_normalizer.batch(refs)
+
+                    yield hypo, refs
+        finally:
+            for fd in refs_fds:
+                fd.close()
+
+    def score_streaming(self, segments):
+        """
+        Two-pass streaming CIDEr: the first pass over the references builds
+        the document frequency table, the second one scores the segments
+        :param segments: function returning a new iterator over
+                         (hypothesis, references) for each pass
+        """
+        df = self.streaming_cider.stream_doc_freq(
+            (refs for _, refs in segments()), self.cider_spill)
+
+        try:
+            score, _ = self.streaming_cider.compute_score_streaming(
+                segments(), df)
+        finally:
+            self.streaming_cider.close_doc_freq(df)
+
+        return score
+
+    def compute_stats(self, refs, hypos):
+        """per-segment sufficient statistics of every metric"""
+        if self.streaming_cider is not None:
+            raise ValueError("streaming CIDEr has no mergeable statistics")
+
+        stats = {}
+
+        for scorer, _ in self.scorers:
+            stats[scorer.method()] = scorer.compute_stats(refs, hypos)
+
+        return stats
+
+    def merge_stats(self, stats):
+        """corpus scores from the (concatenated) output of compute_stats"""
+        if self.streaming_cider is not None:
+            raise ValueError("streaming CIDEr has no mergeable statistics")
+
+        final_scores = {}
+
+        for scorer, metric in self.scorers:
+            score, _ = scorer.merge_stats(stats[scorer.method()])
+            self._collect(final_scores, metric, score)
+
+        return final_scores
+
+    def load(self, live=False, **kwargs):
         if live:
             in_refs = kwargs.pop("refs", {})
             in_hypos = kwargs.pop("hypos", {})
@@ -116,28 +366,46 @@ class Evaluate(object):
                 refs[ids] = in_refs[k]
                 ids += 1
         else:
-            refs_files = kwargs.pop("refs", "")
-            hypos_file = kwargs.pop("hypos", "")
-            refs = {}
-
-            for refs_file in refs_files:
-                with open(refs_file) as fd:
-                    for ids, line in enumerate(fd):
-                        if ids in refs:
-                            refs[ids].extend(line.strip().split("\t"))
-                        else:
-                            refs[ids] = line.strip().split("\t")
-
-            with open(hypos_file) as fd:
-                hypos = fd.readlines()
-                hypos = {ids: [line.strip()] for ids, line in enumerate(hypos)}
-
-        # whether lowercase?
-        if self.lc:
-            final_scores = self.score(_lc(refs), _lc(hypos))
-        else:
-            final_scores = self.score(refs, hypos)
-
+            refs = read_refs(kwargs.pop("refs", ""))
+            hypos = read_hypos(kwargs.pop("hypos", ""))
+
+        # normalize every sentence once before all metrics
+        if self.normalizer.enabled():
+            refs = self.normalizer.apply(refs)
+            hypos = self.normalizer.apply(hypos)
+
+        return refs, hypos
+
+    def score_groups(self, refs, hypos, groups):
+        """
+        Scores of every group and of all segments from a single pass:
+        the per-segment statistics are computed once and each group merges
+        its own segments, so each group gets the scores of evaluating it
+        on its own.
+        :param groups: dict : segment id -> group label
+        :return: final_scores (dict), group -> final_scores (dict)
+        """
+        if set(groups.keys()) != set(refs.keys()):
+            raise ValueError("groups(%d)/refs(%d) mismatch!"
+                             % (len(groups), len(refs)))
+
+        stats = self.compute_stats(refs, hypos)
+        members = collections.defaultdict(list)
+
+        # statistics are listed in sorted segment id order
+        for i, ids in enumerate(sorted(refs.keys())):
+            members[groups[ids]].append(i)
+
+        group_scores = {}
+
+        for group in sorted(members):
+            group_scores[group] = self.merge_stats(dict(
+                (key, [value[i] for i in members[group]])
+                for key, value in stats.items()))
+
+        return self.merge_stats(stats), group_scores
+
+    def report(self, final_scores):
         # output results
         for _, metric in self.scorers:
             if isinstance(metric, list):
@@ -146,12 +414,203 @@ class Evaluate(object):
             else:
                 print("%s: %f" % (metric, final_scores[metric]))
 
+        if self.streaming_cider is not None:
+            print("CIDEr: %f" % final_scores["CIDEr"])
+
+    def _load_checkpoint(self, checkpoint, num_segments, stats):
+        """
+        Read the statistics saved in `checkpoint` into `stats` and return
+        the number of segments they cover, or None if the header of the
+        file is unreadable. A record cut short by a crash is dropped from
+        the file.
+        """
+        with open(checkpoint, "r+b") as fd:
+            try:
+                header = pickle.load(fd)
+            except (EOFError, pickle.UnpicklingError):
+                # the crash happened before the header reached the disk
+                return None
+
+            if header["metrics"] != self.metrics() or \
+                    header.get("settings") != self.settings or \
+                    header["segments"] != num_segments:
+                raise ValueError("%s does not match the metrics, settings or "
+                                 "inputs of this evaluation" % checkpoint)
+
+            offset = 0
+            position = fd.tell()
+
+            while True:
+                try:
+                    record = pickle.load(fd)
+                except (EOFError, pickle.UnpicklingError):
+                    break
+
+                offset = record["offset"]
+                position = fd.tell()
+
+                for key in stats:
+                    stats[key].extend(record["stats"][key])
+
+            fd.truncate(position)
+
+        return offset
+
+    def score_checkpointed(self, refs, hypos, checkpoint,
+                           checkpoint_every=10000, resume=False):
+        """
+        Same as score, but statistics are computed `checkpoint_every`
+        segments at a time and appended to `checkpoint`, so that an
+        interrupted evaluation can be resumed from the last checkpoint
+        """
+        if checkpoint_every <= 0:
+            raise ValueError("checkpoint_every: %d must be a positive "
+                             "integer." % checkpoint_every)
+
+        ids = sorted(refs.keys())
+        stats = dict((scorer.method(), []) for scorer, _ in self.scorers)
+        offset = None
+
+        if resume and os.path.exists(checkpoint):
+            offset = self._load_checkpoint(checkpoint, len(ids), stats)
+
+        if offset is None:
+            offset = 0
+
+            with open(checkpoint, "wb") as fd:
+                pickle.dump({"metrics": self.metrics(),
+                             "settings": self.settings,
+                             "segments": len(ids)},
+                            fd, pickle.HIGHEST_PROTOCOL)
+                fd.flush()
+                os.fsync(fd.fileno())
+
+        with open(checkpoint, "ab") as fd:
+            while offset < len(ids):
+                chunk = ids[offset:offset + checkpoint_every]
+                chunk_stats = self.compute_stats(
+                    dict((k, refs[k]) for k in chunk),
+                    dict((k, hypos[k]) for k in chunk))
+                offset += len(chunk)
+
+                for key in stats:
+                    stats[key].extend(chunk_stats[key])
+
+                pickle.dump({"offset": offset, "stats": chunk_stats},
+                            fd, pickle.HIGHEST_PROTOCOL)
+                fd.flush()
+                os.fsync(fd.fileno())
+
+        return self.merge_stats(stats)
+
+    def evaluate(self, get_scores=True, live=False, checkpoint=None,
+                 checkpoint_every=10000, resume=False, **kwargs):
+        if self.streaming_cider is not None and not live and not checkpoint:
+            # only the other metrics hold the inputs in memory
+            refs_files = kwargs.get("refs", "")
+            hypos_file = kwargs.get("hypos", "")
+            final_scores = {}
+
+            if self.scorers:
+                final_scores = self._score(*self.load(live, **kwargs))
+
+            final_scores["CIDEr"] = self.score_streaming(
+                lambda: self.stream_segments(refs_files, hypos_file))
+        else:
+            refs, hypos = self.load(live, **kwargs)
+
+            if checkpoint:
+                final_scores = self.score_checkpointed(
+                    refs, hypos, checkpoint, checkpoint_every, resume)
+            else:
+                final_scores = self.score(refs, hypos)
+
+        self.report(final_scores)
+
+        if get_scores:
+            return final_scores
+
+    def evaluate_groups(self, groups, get_scores=True, live=False, **kwargs):
+        """
+        Evaluate all segments and every group of segments in one pass
+        :param groups: dict : segment id (or hypothesis key if live) -> group
+        """
+        if live:
+            groups = dict((ids, groups[k]) for ids, k
+                          in enumerate(kwargs.get("hypos", {})))
+
+        refs, hypos = self.load(live, **kwargs)
+        final_scores, group_scores = self.score_groups(refs, hypos, groups)
+        self.report(final_scores)
+
+        for group in sorted(group_scores):
+            print("")
+            print("[%s]" % group)
+            self.report(group_scores[group])
+
+        if get_scores:
+            return final_scores, group_scores
+
+    def partial(self, output, live=False, **kwargs):
+        """
+        Write the sufficient statistics of one shard to `output`,
+        shards are combined into corpus scores by merge
+        """
+        refs, hypos = self.load(live, **kwargs)
+        partial = {"metrics": self.metrics(),
+                   "settings": self.settings,
+                   "stats": self.compute_stats(refs, hypos)}
+
+        with gzip.open(output, "wb") as fd:
+            pickle.dump(partial, fd, pickle.HIGHEST_PROTOCOL)
+
+    def merge(self, partial_files, get_scores=True):
+        """
+        Combine the shard files written by partial into exact corpus scores,
+        shards are concatenated in the given order
+        """
+        stats = dict((scorer.method(), []) for scorer, _ in self.scorers)
+
+        for partial_file in partial_files:
+            with gzip.open(partial_file, "rb") as fd:
+                partial = pickle.load(fd)
+
+            if partial["metrics"] != self.metrics():
+                raise ValueError("%s was computed with metrics %s, "
+                                 "expected %s" % (partial_file,
+                                                  partial["metrics"],
+                                                  self.metrics()))
+
+            if partial.get("settings") != self.settings:
+                raise ValueError("%s was computed with settings %s, "
+                                 "expected %s" % (partial_file,
+                                                  partial.get("settings"),
+                                                  self.settings))
+
+            for key in stats:
+                stats[key].extend(partial["stats"][key])
+
+        final_scores = self.merge_stats(stats)
+        self.report(final_scores)
+
         if get_scores:
             return final_scores
 
 if __name__ == "__main__":
     args = parse_args()
 
+    if args.save_cider_df:
+        refs = read_refs(args.refs)
+        normalizer = Normalizer(lowercase=args.lowercase, punct=args.punct,
+                                unicode_form=args.unicode, ptb=args.ptb)
+
+        if normalizer.enabled():
+            refs = normalizer.apply(refs)
+
+        save_doc_freq(build_doc_freq(
+            [refs[ids] for ids in sorted(refs)]), args.save_cider_df)
+        exit(0)
+
     if args.no_BLEU and args.no_METEOR and args.no_ROUGE and args.no_CIDEr:
         print("Noting to do, please enable at least one metric!")
         exit(0)
@@ -163,5 +622,25 @@ if __name__ == "__main__":
 
     obj = Evaluate(bleu=bleu, meteor=meteor,
                    rouge=rouge, cider=cider,
-                   n=args.ngram, lowercase=args.lowercase)
-    res = obj.evaluate(hypos=args.hypos, refs=args.refs)
+                   n=args.ngram, lowercase=args.lowercase,
+                   punct=args.punct, ptb=args.ptb, unicode_form=args.unicode,
+                   rouge_variants=args.rouge_variants,
+                   rouge_aggregate=args.rouge_aggregate,
+                   rouge_sent_sep=args.rouge_sent_sep,
+                   cider_sigma=args.cider_sigma, cider_df=args.cider_df,
+                   cider_df_ref_len=args.cider_df_ref_len,
+                   cider_streaming=args.cider_streaming,
+                   cider_spill=args.cider_spill)
+
+    if args.merge:
+        res = obj.merge(args.merge)
+    elif args.groups:
+        res = obj.evaluate_groups(read_groups(args.groups),
+                                  hypos=args.hypos, refs=args.refs)
+    elif args.partial:
+        obj.partial(args.partial, hypos=args.hypos, refs=args.refs)
+    else:
+        res = obj.evaluate(hypos=args.hypos, refs=args.refs,
+                           checkpoint=args.checkpoint,
+                           checkpoint_every=args.checkpoint_every,
+                           resume=args.resume)
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import stat
+import sys
+import asyncio
+
+from Metrics.meteor.meteor_async import AsyncMeteor
+
+# stands in for the METEOR jar: the statistics of a segment are its number
+# of hypothesis words, and a segment scores a tenth of that
+FAKE_JAVA = """#!%s
+import sys
+import time
+
+for line in sys.stdin:
+    fields = line.rstrip("\\n").split(" ||| ")
+
+    if fields[0] == "SCORE":
+        if "slow" in fields[-1]:
+            time.sleep(0.5)
+
+        print("%%d 1" %% len(fields[-1].split()), flush=True)
+    elif fields[0] == "EVAL":
+        scores = [int(s.split()[0]) / 10.0 for s in fields[1:]]
+
+        for score in scores:
+            print(score, flush=True)
+
+        print(sum(scores) / len(scores), flush=True)
+""" % sys.executable
+
+
+def fake_meteor(tmp_path, monkeypatch):
+    java = tmp_path / "java"
+    java.write_text(FAKE_JAVA)
+    java.chmod(java.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv("PATH", str(tmp_path) + os.pathsep +
+                       os.environ.get("PATH", ""))
+
+    return AsyncMeteor()
+
+
+def test_cancelled_request_does_not_leak_replies(tmp_path, monkeypatch):
+    meteor = fake_meteor(tmp_path, monkeypatch)
+
+    async def run():
+        try:
+            # cancelled while METEOR is still scoring the segment
+            await asyncio.wait_for(meteor.compute_score(
+                {0: ["a b c"]}, {0: ["slow slow slow"]}), 0.1)
+        except asyncio.TimeoutError:
+            pass
+        else:
+            raise AssertionError("the request was not cancelled")
+
+        try:
+            return await meteor.compute_score({0: ["a b c"]},
+                                              {0: ["one two"]})
+        finally:
+            await meteor.close()
+
+    final_score, scores = asyncio.run(run())
+
+    assert scores == [0.2]
+    assert abs(final_score - 20.0) < 1e-9